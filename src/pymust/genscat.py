@@ -1,10 +1,10 @@
 from __future__ import annotations
-import scipy, scipy.interpolate
+import scipy, scipy.ndimage
 from typing import Union
 from . import utils
 import numpy as np
 
-def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, None]  = None, g: Union[np.ndarray, float] = None)  -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, None]  = None, g: Union[np.ndarray, float] = None, shuffle: bool = True, seed: Union[int, None] = None, dtype: np.dtype = np.float32, backend: str = 'numpy')  -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     %GENSCAT   Generate a distribution of scatterers
     %   [XS,YS,ZS] = GENSCAT([WIDTH HEIGHT],MEANDIST) generates a 2-D
@@ -40,6 +40,20 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
     %   image I is G dB (defaut value = 40 dB). If G<=1, it is assumed that the
     %   image I is gamma-compressed, with gamma = G.
     %
+    %   [...] = GENSCAT(...,shuffle=False) returns the scatterers in the order
+    %   of the grid cells they were drawn from, instead of randomly reordering
+    %   them. Use it when the downstream processing is order-invariant.
+    %
+    %   [...] = GENSCAT(...,seed=SEED) seeds the pseudorandom number generator
+    %   (numpy.random.default_rng) for reproducible distributions.
+    %
+    %   [...] = GENSCAT(...,dtype=DTYPE) returns arrays of type DTYPE
+    %   (np.float32, by default, as used by PFIELD and SIMUS, or np.float64).
+    %
+    %   [...] = GENSCAT(...,backend='cupy') generates the scatterers and their
+    %   RCs on the GPU with CuPy (which must be installed). The outputs are
+    %   then CuPy arrays; use cupy.asnumpy to bring them back to the host.
+    %
     %   Note on MEANDIST:
     %   ---------------- 
     %   We recommend a MEANDIST value less than or equal to the minimum
@@ -115,14 +129,14 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
         assert isinstance(meandist, float) and meandist>0, 'MEANDIST must be a positive scalar.'
     
     if I is not None:
-        assert len(I.shape) in [2, 3] and np.all(I>=0), 'I must be 2-D or 3-D with non-negative elements.'
+        assert len(I.shape) in [2, 3] and np.min(I)>=0, 'I must be 2-D or 3-D with non-negative elements.'
         assert len(roidim)== len(I.shape), 'The number of dimensions of I does not match the length of the 1st argument.'
     else:
         assert np.all(np.isfinite(roidim)), 'The 1st argument must contain only finite elements if I is not given.'
         assert g is None, 'The 4th argument g cannot be used if I is not given.' #Note GB: actually a warning should be enough
 
     ##%-- Calculate xmin, xmax, ymin, ymax, and zmax (we have zmin = 0)
-    width,height  = roidim
+    width,height  = roidim[:2]
     #%
     if len(roidim)==2: #% 2-D
         assert np.any((np.isfinite(roidim))), 'The vector [WIDTH HEIGHT] must contain at least one finite element.'
@@ -158,22 +172,26 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
     zmax = height
 
 
+    #%-- Array backend (CPU or GPU)
+    if backend == 'numpy':
+        xp, ndimage = np, scipy.ndimage
+    elif backend == 'cupy':
+        import cupy as xp, cupyx.scipy.ndimage as ndimage
+    else:
+        raise ValueError('BACKEND must be "numpy" or "cupy".')
+
+
     #%-- Pseudorandom distribution of the scatterers
+    #% one scatterer per cell of a regular grid that tiles the ROI; the
+    #% scatterers are thus inside the ROI by construction
+    rng = xp.random.default_rng(seed)
     if len(roidim)==2: #% 2-D
         #%-- 2-D pseudorandom distribution --
         
         xz_inc = meandist/np.sqrt(2/5)
         #% note: sqrt(2/5) was determined numerically (theory = ?...)
         
-        xs,zs =np.meshgrid( np.arange(xmin, xmax, xz_inc), np.arange(zmin, zmax, xz_inc))
-        xs = xs + np.random.rand(*xs.shape)*xz_inc-xz_inc/2
-        zs = zs + np.random.rand(*zs.shape)*xz_inc-xz_inc/2
-        
-        idx = np.logical_and(np.logical_and(xs>xmin, xs<xmax), np.logical_and(zs>zmin, zs<zmax))
-        xs = xs[idx]
-        zs = zs[idx]
-        
-        ys = np.zeros(xs.shape)
+        xyz = jitteredGrid([xmin, zmin], [xmax, zmax], xz_inc, rng, dtype, xp)
 
     else: #% 3-D
         #%-- 3-D pseudorandom distribution --
@@ -181,47 +199,50 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
         xyz_inc = meandist/np.sqrt(16/39)
         #% note: sqrt(16/39) was determined numerically (theory = ?...)
         
-        xs,ys,zs = np.meshgrid(np.arange(xmin, xmax, xz_inc), 
-                               np.arange(ymin, ymax, xz_inc),
-                               np.arange(zmin, zmax, xz_inc))
-        xs = xs + np.random.rand(*xs.shape)*xz_inc-xz_inc/2
-        zs = zs + np.random.rand(*zs.shape)*xz_inc-xz_inc/2
-        ys = ys + np.random.rand(*ys.shape)*xz_inc-xz_inc/2
+        xyz = jitteredGrid([xmin, ymin, zmin], [xmax, ymax, zmax], xyz_inc, rng, dtype, xp)
 
-        
-        idx = np.logical_and.reduce((xs>xmin, xs<xmax, ys>ymin, ys<ymax, zs>zmin, zs<zmax))
-        xs = xs[idx]
-        ys = ys[idx]
-        zs = zs[idx]
-        
 
+    #% Random reordering (in place, all coordinates at once)
+    if shuffle:
+        if xp is np:
+            #% the rows are shuffled through a 1-D view (one void item per
+            #% row, xyz being C-contiguous): Generator.shuffle is much slower
+            #% on the rows of a 2-D array
+            rng.shuffle(xyz.view(np.dtype((np.void, xyz.itemsize*xyz.shape[1]))).ravel())
+        else: #% the CuPy Generator has no shuffle: sort random keys
+            #% (float64 keys: float32 ones would tie for large N)
+            xyz = xyz[xp.argsort(rng.random(xyz.shape[0], dtype = np.float64))]
 
-    #% Random reordering
-    idx = np.random.permutation(len(xs))
-    xs = xs[idx]
-    ys = ys[idx]
-    zs = zs[idx]
+    if len(roidim)==2:
+        xs, zs = xyz[:,0], xyz[:,1]
+        ys = xp.zeros(xs.shape, dtype = dtype)
+    else:
+        xs, ys, zs = xyz[:,0], xyz[:,1], xyz[:,2]
 
 
     #%-- If no I: the reflection coefficients follow a Rayleigh
     #%            distribution of mean 1
     if I is None:
-        RC = np.random.rayleigh(1,xs.shape)/np.sqrt(np.pi/2)
+        RC = raylrnd(rng, 1/np.sqrt(np.pi/2), xs.shape, dtype, xp)
 
     else:
 
-        I = I.astype(float)
-        I = I/np.max(I)
+        #% I is sampled as is: its normalization by max(I) is folded into the
+        #% compression below (no copy of I at each call)
+        I = xp.asarray(I)
+        Imax = xp.max(I)
 
 
         #%-- Image grid
+        #% The pixel centers are at (xmin+dxi/2, zmin+dzi/2) + (j*dxi, i*dzi):
+        #% the scatterer coordinates are converted to (fractional) pixel indices
         if len(roidim)==2:
             #%-- 2-D image grid
             assert len(I.shape) == 2,'Number of dimensions of I is not consistent with the first input vector.'
             nl,nc = I.shape
             dxi = (xmax-xmin)/nc
             dzi = (zmax-zmin)/nl
-            xi,zi = np.linspace(xmin-dxi/2,xmax-dxi/2,nc), np.linspace(zmin+dzi/2,zmax-dzi/2,nl)
+            coords = xp.vstack([(zs-zmin)/dzi-0.5, (xs-xmin)/dxi-0.5])
             
         elif  len(roidim)==3:
             #%-- 3-D image grid    
@@ -230,9 +251,7 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
             dxi = (xmax-xmin)/nc
             dyi = (ymax-ymin)/nr
             dzi = (zmax-zmin)/nl
-            xi,zi,yi = np.linspace(xmin+dxi/2,xmax-dxi/2,nc), \
-                np.linspace(zmin+dzi/2,zmax-dzi/2,nl), \
-                np.linspace(ymin+dyi/2,ymax-dyi/2,np)
+            coords = xp.vstack([(zs-zmin)/dzi-0.5, (xs-xmin)/dxi-0.5, (ys-ymin)/dyi-0.5])
         else:
             raise ValueError('Incorrect roidim size')
 
@@ -241,22 +260,62 @@ def genscat(roidim : np.ndarray, meandist: np.ndarray ,I : Union[np.ndarray, Non
         if g is None:
             g = 40  #% default value for log compression
         
-        if len(roidim)==2:
-            interp =  scipy.interpolate.RegularGridInterpolator([xi,zi], I.T, method = 'linear', fill_value=0, bounds_error = False)
-            RC = interp(np.stack([xs,zs], axis = -1))
-        elif len(roidim)==3:
-            interp =  scipy.interpolate.RegularGridInterpolator([xi, yi, zi], I, method = 'linear', fill_value=0, bounds_error = False)
-            RC = interp(np.stack([xs,ys,zs], axis = -1))
+        #% linear interpolation, the axes of I being (z,x) in 2-D and (z,x,y) in 3-D
+        RC = ndimage.map_coordinates(I, coords, output = dtype, order = 1, mode = 'constant', cval = 0.0)
         
+        #% (in place, RC is a new array returned by map_coordinates)
         if g>1:
-            #% log compression
-            RC = np.power(10,(g/20*(RC-1)))
+            #% log compression: 10^(g/20*(RC/Imax-1)) = exp(k/Imax*RC-k),
+            #% with k = g*log(10)/20
+            k = g*np.log(10)/20
+            RC *= k/Imax
+            RC -= k
+            xp.exp(RC, out = RC)
         else:
             #% gamma compression
-            RC = np.power(RC, 1/g)
+            RC /= Imax
+            xp.power(RC, 1/g, out = RC)
 
         #% add some randomness in the reflection coefficients
         #% RC = RC.*raylrnd(1,1,length(xs))'/sqrt(pi/2);
-        RC = RC*np.hypot(np.random.rand(*xs.shape),np.random.rand(*xs.shape))/np.sqrt(np.pi/2)
+        #% note: raylrnd(B)/sqrt(pi/2) follows a Rayleigh distribution of
+        #% scale B/sqrt(pi/2)
+        RC *= raylrnd(rng, 1/np.sqrt(np.pi/2), xs.shape, dtype, xp)
+
+    return xs,ys,zs,RC
 
-    return xs,ys,zs,RC
\ No newline at end of file
+
+def jitteredGrid(mins, maxs, inc, rng, dtype = np.float64, xp = np):
+    """
+    Draw one point uniformly in each cell of a regular grid, of step close to
+    INC, that tiles the box [MINS, MAXS]. Returns a C-contiguous (N, ndim)
+    DTYPE array (GENSCAT shuffles its rows through a 1-D void view). The
+    points are written in place into this single buffer (no temporary arrays).
+    XP is the array module (numpy or cupy) of the Generator RNG.
+    """
+    ndim = len(mins)
+    mins = np.asarray(mins, dtype = float)
+    maxs = np.asarray(maxs, dtype = float)
+    n = [max(round((maxs[k]-mins[k])/inc), 1) for k in range(ndim)]
+    xyz = rng.random((*n, ndim), dtype = dtype)
+    for k in range(ndim):
+        shape = [1]*ndim
+        shape[k] = -1
+        xyz[..., k] += xp.arange(n[k]).reshape(shape) # cell indices
+    xyz *= xp.asarray((maxs-mins)/n)
+    xyz += xp.asarray(mins)
+    return xyz.reshape((-1, ndim))
+
+
+
+def raylrnd(rng, B, size, dtype = np.float64, xp = np):
+    """
+    Rayleigh random numbers of scale B: B*sqrt(2*E), E being standard
+    exponential, as in Generator.rayleigh, but computed in place in type
+    DTYPE and also available with a CuPy Generator (which has no rayleigh).
+    """
+    R = rng.standard_exponential(size, dtype = dtype)
+    R *= 2
+    xp.sqrt(R, out = R)
+    R *= B
+    return R
@@ -1,4 +1,5 @@
 from . import utils
+import math
 import numpy as np
 import scipy.optimize
 
@@ -30,7 +31,8 @@ def txdelay3(*args):
     DELAYS = TXDELAY3(PARAM,TILTx,TILTy) returns the transmit time delays
     for a tilted plane wave. TILTx is the tilt angle about the X-axis.
     TILTy is the tilt angle about the Y-axis. If TILTx = TILTy = 0, then
-    the delays are 0.
+    the delays are 0. TILTx and TILTy can be vectors. In that case, DELAYS
+    is a matrix whose rows contain the different delay laws.
 
     DELAYS = TXDELAY3(PARAM,TILTx,TILTy,OMEGA) yields the transmit time
     delays for a diverging wave. The sector is characterized by the angular
@@ -185,17 +187,13 @@ def txdelay3(*args):
 
     c = param.c
 
-
-    #-- Positions of the transducer elements
-    x, z, THe, h= param.getElementPositions()
-
     if option == 'Plane Wave':
-        # DR : problems checking if it is not a vector, used as a number later, no need for casting into array
-        tiltx = args[1] # tiltx = np.array(args[1]).reshape((-1, 1))
-        tilty = args[2] # tilty = np.array(args[2]).reshape((-1, 1))
-        assert np.isscalar(tiltx+tilty), 'TILTx and TILTy must be two scalars.'
-        assert np.all(np.abs(np.array([tiltx,tilty]))<np.pi/2), 'The tilt angles must verify |TILTx| and |TILTy| < pi/2'
-        delays = (xe*np.sin(tilty)-ye*np.sin(tiltx))/c
+        # TILTx and TILTy can be vectors: one delay law (row) per tilt pair
+        tiltx = np.array(args[1], dtype=float).reshape((-1, 1))
+        tilty = np.array(args[2], dtype=float).reshape((-1, 1))
+        assert len(tiltx)==len(tilty) or len(tiltx)==1 or len(tilty)==1, 'TILTx and TILTy must be scalars or vectors of the same length.'
+        assert np.all(np.abs(tiltx)<np.pi/2) and np.all(np.abs(tilty)<np.pi/2), 'The tilt angles must verify |TILTx| and |TILTy| < pi/2'
+        delays = xe*(np.sin(tilty)/c) - ye*(np.sin(tiltx)/c) # 1/c applied to the tilt vectors only
     #-----
     elif option == 'Diverging Wave':
         # DR : problems checking if it is not a vector, used as a number later, no need for casting into array
@@ -208,22 +206,25 @@ def txdelay3(*args):
         assert omega>=0, 'The solid angle must be nonnegative'
 
         # check if the elements are on a plaid grid
-        uxe = np.unique(xe)
-        uye = np.unique(ye)
-        [xep,yep] = np.meshgrid(uxe,uye)
-        test = np.all(np.sort(xep.flatten())==np.sort(xe)) & np.all(np.sort(yep.flatten())==np.sort(ye))
+        # i.e. the distinct (x,y) pairs are all the combinations of the distinct x and y
+        nxe = np.unique(xe).size
+        nye = np.unique(ye).size
+        npairs = np.unique(np.column_stack((xe.ravel(), ye.ravel())), axis=0).shape[0]
+        test = npairs == nxe*nye == xe.size
         assert test, 'The elements must be on a plaid grid with the "Diverging wave" option, i.e. the element positions must form a plaid grid.'
 
         # rotation of the point [0,0,-1]
         # TILTx about the x-axis, TILTy about the y-axis
-        x = -np.sin(tilty)*np.cos(tiltx)
-        y = np.sin(tiltx)
-        z = -np.cos(tilty)*np.cos(tiltx)
+        # (scalar tilts: math functions avoid the ufunc overhead)
+        cos_tiltx = math.cos(tiltx)
+        x = -math.sin(tilty)*cos_tiltx
+        y = math.sin(tiltx)
+        z = -math.cos(tilty)*cos_tiltx
 
         # corresponding azimuth and elevation
         # [az,el] = cart2sph(x,y,z);
-        az = np.arctan2(y,x)
-        el = np.arctan2(z,np.sqrt(x**2 + y**2))
+        az = math.atan2(y,x)
+        el = math.atan2(z,math.hypot(x,y))
 
         # dimensions of the matrix array
         l = np.max(xe)-np.min(xe)+param.width # width of the matrix array
@@ -232,16 +233,32 @@ def txdelay3(*args):
 
         # we know the azimuth and elevation of the virtual source
         # we need its radial position r for the given solid angle
+        # The solid angle decreases monotonically from 2pi (r = 0) as r
+        # increases: its root is bracketed on a coarse grid of [rmin, 2pi]
+        # (log-spaced, evaluated at once) and then found with Brent's method.
         def myfun(r, omega=omega, l=l, b=b, az=az, el=el):
-            return abs(solidAngle(r,l,b,az,el) - omega) # Define the function to minimize
-        r = scipy.optimize.fminbound(myfun, 0, 2*np.pi, xtol=1e-6) # DR : function tolerance not being taken into account.
-        # r = scipy.optimize.minimize_scalar(myfun, bounds=(0, 2*np.pi), method='bounded', options={'xatol': 1e-6, 'fatol': 1e-6}) # DR : alternative (not tried)
+            return solidAngle(r,l,b,az,el) - omega # Define the function whose root is sought
+        # r must stay positive: r = 0 would give z0 = 0, i.e. zero delays
+        # instead of the limiting diverging wave
+        rmin = 1e-12
+        rs = np.geomspace(rmin, 2*np.pi, 64) # no need to evaluate at r = 0, where it is 2pi
+        fs = myfun(rs)
+        if fs[0]<=0: # OMEGA ~ 2pi: the root is below rmin
+            r = rmin
+        elif fs[-1]>=0: # OMEGA ~ 0: not reachable within [0, 2pi]
+            r = 2*np.pi
+        else:
+            k = np.argmax(fs<=0) # first grid point beyond the root
+            # relative tolerance: the root can be close to 0 when OMEGA ~ 2pi
+            r = scipy.optimize.brentq(myfun, rs[k-1], rs[k], xtol=1e-15, rtol=1e-10)
+            r = max(r, rmin)
 
         # position of the virtual source, and TX delays
-        cos_el = np.cos(el)
-        x0 = r*cos_el*np.cos(az)
-        y0 = r*cos_el*np.sin(az)
-        z0 = r*np.sin(el)
+        # note: (x,y,z) is the unit vector of azimuth az and elevation el,
+        # i.e. (cos(el)*cos(az), cos(el)*sin(az), sin(el))
+        x0 = r*x
+        y0 = r*y
+        z0 = r*z
         delays = txdelay3(x0,y0,z0,param)
 
     #-----
@@ -253,10 +270,16 @@ def txdelay3(*args):
         if len(x0)==1: # focus point
             d = np.sqrt((xe-x0)**2 + (ye-y0)**2 + z0**2)
         elif len(x0)==2: # focus line
+            # distance to the line = |(X-x1) x (X-x2)| / |x2-x1|, with X = (xe,ye,0)
+            x1 = np.concatenate((x0[0],y0[0],z0[0])).reshape((-1,1))
+            x2 = np.concatenate((x0[1],y0[1],z0[1])).reshape((-1,1))
             X = np.concatenate((xe, ye, np.zeros_like(xe)), axis=0)
-            x1 = np.tile(np.concatenate((x0[0],y0[0],z0[0]), axis=0).reshape((-1,1), order="F"), (1, x0.shape[1]))
-            x2 = np.tile(np.concatenate((x0[1],y0[1],z0[1]), axis=0).reshape((-1,1), order="F"), (1, x0.shape[1]))
-            d = np.linalg.norm(np.cross(X-x1,X-x2, axis=0), axis=0)/np.linalg.norm(x2-x1)
+            a = X-x1
+            b = X-x2
+            cx = a[1]*b[2]-a[2]*b[1]
+            cy = a[2]*b[0]-a[0]*b[2]
+            cz = a[0]*b[1]-a[1]*b[0]
+            d = np.sqrt(cx**2 + cy**2 + cz**2)/np.linalg.norm(x2-x1)
         else:
             ValueError('X0, Y0, and Z0 must have 1 or 2 elements.')
         delays = -d/c*np.sign(z0)
@@ -281,15 +304,20 @@ def solidAngle(r, l, b, az, el):
     # JOSA 58.10 (1968): 1417-1418.
 
     # notations from Harish Chandra Rajpoot
-    L1 = l/2 + r*np.cos(el)*np.cos(az)
-    L2 = -l/2 + r*np.cos(el)*np.cos(az)
-    B1 = b/2 + r*np.cos(el)*np.sin(az)
-    B2 = b/2 - r*np.cos(el)*np.sin(az)
-    H = r*np.sin(el)
+    # r can be an array: the solid angle is then calculated for each r
+    rcos_el = r*np.cos(el)
+    rx = rcos_el*np.cos(az)
+    ry = rcos_el*np.sin(az)
+    L1 = l/2 + rx
+    L2 = -l/2 + rx
+    B1 = b/2 + ry
+    B2 = b/2 - ry
+    H2 = (r*np.sin(el))**2
 
     # Solid angle calculation
     def w(l, b):
-        return np.arcsin(l*b/np.hypot(l, H)/np.hypot(b, H))
+        # the ratio can exceed 1 by a rounding error when H ~ 0
+        return np.arcsin(np.clip(l*b/np.sqrt((l*l + H2)*(b*b + H2)), -1, 1))
 
     O = w(L1, B1) + w(L1, B2) - w(L2, B1) - w(L2, B2)
     return O